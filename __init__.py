@@ -1,9 +1,16 @@
-import io
 import json
+import math
+import os
+import sys
+import threading
+import time
+import urllib.error
 import urllib.request
+from collections.abc import Iterable, Iterator
 from contextlib import suppress
 from datetime import UTC, datetime, timedelta
-from xml.etree import ElementTree as ET
+from functools import lru_cache, partial
+from pathlib import Path
 
 from albert import (  # pylint: disable=import-error
     Action,
@@ -11,8 +18,14 @@ from albert import (  # pylint: disable=import-error
     StandardItem,
     TriggerQueryHandler,
     setClipboardText,
+    warning,
 )
 
+try:
+    from lxml import etree as ET  # pyright: ignore[reportMissingImports, reportAttributeAccessIssue]
+except ImportError:
+    from xml.etree import ElementTree as ET
+
 
 md_iid = '2.3'
 md_version = '1.3'
@@ -21,47 +34,152 @@ md_description = 'Convert currencies'
 md_url = 'https://github.com/stevenxxiu/albert_currency_converter_steven'
 md_maintainers = '@stevenxxiu'
 
-ICON_URL = 'file:/usr/share/icons/elementary/apps/128/accessories-calculator.svg'
+ICON_URLS = ['file:/usr/share/icons/elementary/apps/128/accessories-calculator.svg']
 
 
 class EuropeanCentralBank:
     URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-daily.xml'
     CACHE_TIME = timedelta(hours=3)
+    CACHE_SECONDS = CACHE_TIME.total_seconds()
+    # After a failed fetch, keep serving stale rates for a while before retrying
+    RETRY_SECONDS = 5 * 60
+    OPENER = urllib.request.build_opener()
+    # A hung fetch would otherwise block all later refreshes
+    TIMEOUT_SECONDS = 10
+    # Default namespace of the feed, which has been stable for years
+    NAMESPACE = 'http://www.ecb.int/vocabulary/2002-08-01/eurofxref'
+    CUBE_TAG = f'{{{NAMESPACE}}}Cube'
 
     def __init__(self) -> None:
+        # Wall clock time for the on-disk cache, and monotonic time for expiry checks
         self.last_update: datetime = datetime.fromtimestamp(0, UTC)
+        self.last_update_mono: float = -math.inf
         self.euro_to_currency: dict[str, float] = {}
+        # Validators from the last response, for conditional requests
+        self.etag: str | None = None
+        self.last_modified: str | None = None
+        self.cache_path: Path | None = None
+        # Held while a refresh is in flight
+        self.refresh_lock = threading.Lock()
+
+    def load_cache(self, path: Path) -> None:
+        # Rates from a previous session, so the first query doesn't need a fetch
+        self.cache_path = path
+        # A malformed cache is ignored, leaving state untouched
+        with suppress(OSError, ValueError, KeyError, TypeError, AttributeError):
+            data = json.loads(path.read_text())
+            last_update = datetime.fromisoformat(data['last_update'])
+            if last_update.tzinfo is None:
+                raise ValueError
+            euro_to_currency = {sys.intern(currency): float(rate) for currency, rate in data['rates'].items()}
+            last_update_mono = time.monotonic() - (datetime.now(UTC) - last_update).total_seconds()
+            etag = data.get('etag')
+            last_modified = data.get('last_modified')
+            if not all(value is None or isinstance(value, str) for value in (etag, last_modified)):
+                raise ValueError
+
+            self.euro_to_currency = euro_to_currency
+            self.last_update = last_update
+            self.last_update_mono = last_update_mono
+            self.etag = etag
+            self.last_modified = last_modified
+
+    def save_cache(self) -> None:
+        if self.cache_path is None:
+            return
+        data = {
+            'rates': self.euro_to_currency,
+            'last_update': self.last_update.isoformat(),
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+        }
+        with suppress(OSError):
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(data))
+            os.replace(tmp_path, self.cache_path)
 
     def update_exchange_rates(self) -> None:
-        cur_time = datetime.now(UTC)
-        if cur_time - self.last_update <= self.CACHE_TIME:
+        # Fetch in the background, queries use the current rates until it's done
+        if time.monotonic() - self.last_update_mono <= self.CACHE_SECONDS:
             return
+        if not self.refresh_lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+            return
+        threading.Thread(target=self.refresh_exchange_rates, daemon=True).start()
 
-        self.euro_to_currency.clear()
-        self.euro_to_currency['EUR'] = 1.0
+    def refresh_exchange_rates(self) -> None:
+        try:
+            self.fetch_exchange_rates()
+        except (OSError, ValueError, KeyError, ET.ParseError) as e:
+            warning(f'Failed to fetch exchange rates: {e}')
+            self.last_update_mono = time.monotonic() - self.CACHE_SECONDS + self.RETRY_SECONDS
+        finally:
+            self.refresh_lock.release()
 
-        with urllib.request.urlopen(EuropeanCentralBank.URL) as response:
-            response_bytes = response.read()
+    def fetch_exchange_rates(self) -> None:
+        headers = {}
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified is not None:
+            headers['If-Modified-Since'] = self.last_modified
+        request = urllib.request.Request(EuropeanCentralBank.URL, headers=headers)
 
-            namespaces = {
-                prefix: namespace
-                for _, (prefix, namespace) in ET.iterparse(io.BytesIO(response_bytes), events=['start-ns'])
-            }
-            namespace = namespaces['']
+        try:
+            response = EuropeanCentralBank.OPENER.open(  # pylint: disable=consider-using-with
+                request, timeout=EuropeanCentralBank.TIMEOUT_SECONDS
+            )
+        except urllib.error.HTTPError as e:
+            # Rates haven't changed since the last fetch
+            if e.code == 304:
+                # The error holds the open response
+                e.close()
+                self.last_update = datetime.now(UTC)
+                self.last_update_mono = time.monotonic()
+                self.save_cache()
+                return
+            raise
 
-            root = ET.parse(io.BytesIO(response_bytes))
-            for leaf in root.findall(f'./{{{namespace}}}Cube/{{{namespace}}}Cube/{{{namespace}}}Cube'):
-                self.euro_to_currency[leaf.attrib['currency']] = float(leaf.attrib['rate'])
+        euro_to_currency = {'EUR': 1.0}
+        with response:
+            cube_tag = EuropeanCentralBank.CUBE_TAG
+            for event, value in ET.iterparse(response, events=['start-ns', 'end']):
+                if event == 'start-ns':
+                    prefix, uri = value
+                    # `lxml` may report the default namespace prefix as `None`
+                    if not prefix and uri != EuropeanCentralBank.NAMESPACE:
+                        cube_tag = f'{{{uri}}}Cube'
+                elif value.tag == cube_tag:
+                    # Only the innermost `Cube` elements have rates
+                    currency = value.get('currency')
+                    if currency is not None:
+                        euro_to_currency[sys.intern(currency)] = float(value.attrib['rate'])
+                        value.clear()
+            etag = response.headers['ETag']
+            last_modified = response.headers['Last-Modified']
 
+        self.euro_to_currency = euro_to_currency
+        self.etag = etag
+        self.last_modified = last_modified
         self.last_update = datetime.now(UTC)
+        self.last_update_mono = time.monotonic()
+        self.save_cache()
 
-    def get_amount_in_dest_currency(self, src_amount: float, src_currency: str, dest_currency: str) -> float:
+    def convert_many(
+        self, src_amount: float, src_currency: str, dest_currencies: Iterable[str]
+    ) -> Iterator[tuple[str, float]]:
+        # Yields `(dest_currency, dest_amount)`, skipping currencies without a rate
         self.update_exchange_rates()
 
-        if src_currency not in self.euro_to_currency or dest_currency not in self.euro_to_currency:
-            raise ValueError
+        euro_to_currency = self.euro_to_currency
+        src_rate = euro_to_currency.get(src_currency)
+        if src_rate is None:
+            return
+        euro_amount = src_amount / src_rate
 
-        return src_amount / self.euro_to_currency[src_currency] * self.euro_to_currency[dest_currency]
+        for dest_currency in dest_currencies:
+            dest_rate = euro_to_currency.get(dest_currency)
+            if dest_rate is not None:
+                yield dest_currency, euro_amount * dest_rate
 
 
 european_central_bank = EuropeanCentralBank()
@@ -80,65 +198,67 @@ class Plugin(PluginInstance, TriggerQueryHandler):
         PluginInstance.__init__(self)
         # `{ alias: currency_name }`
         self.aliases: dict[str, str] = {}
-        # `[currency_name]`
-        self.defaults_dests: list[str] = []
+        # `(currency_name,)`
+        self.defaults_dests: tuple[str, ...] = ()
 
         with suppress(FileNotFoundError):
             with (self.configLocation / 'settings.json').open() as sr:
                 settings = json.load(sr)
 
             if 'aliases' in settings:
-                for currency_name, aliases in settings['aliases'].items():
-                    for alias in aliases:
-                        self.aliases[alias.lower()] = currency_name.upper()
+                self.aliases = {
+                    sys.intern(alias.lower()): sys.intern(currency_name.upper())
+                    for currency_name, aliases in settings['aliases'].items()
+                    for alias in aliases
+                }
             if 'defaults' in settings:
-                self.defaults_dests = settings['defaults']
+                # Currencies are in upper case
+                self.defaults_dests = tuple(sys.intern(currency_name.upper()) for currency_name in settings['defaults'])
+
+        european_central_bank.load_cache(self.cacheLocation / 'ecb_cache.json')
+        european_central_bank.update_exchange_rates()
+
+        # The same few currencies are looked up on every keystroke
+        self.get_alias = lru_cache(maxsize=256)(self._get_alias)
 
-    def get_alias(self, currency_name: str) -> str:
+    def _get_alias(self, currency_name: str) -> str:
         # Lower case first, as aliases are in lower case
         currency_name = currency_name.lower()
         currency_name = self.aliases.get(currency_name, currency_name)
-        # Currencies are in upper case
-        return currency_name.upper()
+        # Currencies are in upper case, and interned as they're used as keys
+        return sys.intern(currency_name.upper())
 
     @staticmethod
-    def add_item(query, src_amount: float, src_currency: str, dest_currency: str) -> None:
-        try:
-            dest_amount = european_central_bank.get_amount_in_dest_currency(src_amount, src_currency, dest_currency)
-            dest_amount_str = f'{dest_amount:.2f} {dest_currency}'
-            query.add(
-                StandardItem(
-                    id=md_name,
-                    text=dest_amount_str,
-                    subtext=f'Value of {src_amount:.2f} {src_currency} in {dest_currency}',
-                    iconUrls=[ICON_URL],
-                    actions=[Action(md_name, md_name, lambda: setClipboardText(dest_amount_str))],
-                )
+    def add_item(query, src_amount: float, src_currency: str, dest_currency: str, dest_amount: float) -> None:
+        dest_amount_str = f'{dest_amount:.2f} {dest_currency}'
+        query.add(
+            StandardItem(
+                id=md_name,
+                text=dest_amount_str,
+                subtext=f'Value of {src_amount:.2f} {src_currency} in {dest_currency}',
+                iconUrls=ICON_URLS,
+                actions=[Action(md_name, md_name, partial(setClipboardText, dest_amount_str))],
             )
-        except ValueError:
-            pass
+        )
 
     def handleTriggerQuery(self, query) -> None:
+        parts = query.string.split()
+        if not 2 <= len(parts) <= 3:
+            return
+        src_amount, src_currency, *rest = parts
+        # Check the amount first, as it's cheapest and rules out most partially typed queries
         try:
-            parts = query.string.split()
-            match len(parts):
-                case 2:
-                    src_amount, src_currency = parts
-                    dest_currency = None
-                case 3:
-                    src_amount, src_currency, dest_currency = parts
-                case _:
-                    raise ValueError
             src_amount = float(src_amount)
-            src_currency = self.get_alias(src_currency)
-            if dest_currency is not None:
-                dest_currency = self.get_alias(dest_currency)
         except ValueError:
             return
 
+        src_currency = self.get_alias(src_currency)
+        dest_currency = self.get_alias(rest[0]) if rest else None
+
         if dest_currency is not None:
-            self.add_item(query, src_amount, src_currency, dest_currency)
+            dest_currencies = (dest_currency,)
         else:
-            for dest_currency in self.defaults_dests:
-                if dest_currency != src_currency:
-                    self.add_item(query, src_amount, src_currency, dest_currency)
+            dest_currencies = tuple(currency for currency in self.defaults_dests if currency != src_currency)
+
+        for dest_currency, dest_amount in european_central_bank.convert_many(src_amount, src_currency, dest_currencies):
+            self.add_item(query, src_amount, src_currency, dest_currency, dest_amount)